@@ -19,11 +19,16 @@ Note:
 """
 
 import logging
-import base64
-import json
+import binascii
+import functools
+import socket
+from collections import OrderedDict
+from itertools import chain
 from dataclasses import dataclass
-from typing import Optional, Dict
+from typing import Optional, Dict, Iterable, Set, Tuple, List
 
+import msgpack
+import orjson
 import redis
 import hashlib
 
@@ -37,11 +42,17 @@ from certomancer.registry import ArchLabel, CertLabel
 from werkzeug import Request, Response
 from werkzeug.middleware.dispatcher import DispatcherMiddleware
 from werkzeug.exceptions import NotFound, HTTPException, MethodNotAllowed, \
-    BadRequest
+    BadRequest, RequestEntityTooLarge
 
 
 logger = logging.getLogger(__name__)
 
+# Prefer the libyaml-backed loader, since config parsing is on the hot path
+try:
+    from yaml import CSafeLoader as _SafeLoader
+except ImportError:
+    from yaml import SafeLoader as _SafeLoader
+
 
 @dataclass(frozen=True)
 class Settings(config_utils.ConfigurableMixin):
@@ -54,6 +65,15 @@ class Settings(config_utils.ConfigurableMixin):
     redis_port: int = 6379
     """Redis port"""
 
+    redis_socket: Optional[str] = None
+    """
+    Path to a Unix domain socket to connect to redis with. If set, this takes
+    precedence over the host and port.
+    """
+
+    redis_pool_size: int = 32
+    """Maximal number of connections to redis per worker."""
+
     config_search_dir: Optional[str] = None
     """Directory to scan for PKI architecture files."""
 
@@ -68,6 +88,25 @@ class Settings(config_utils.ConfigurableMixin):
     (in seconds).
     """
 
+    max_config_size: int = 4 * 1024 * 1024
+    """
+    Maximal size of a configuration submitted through the configuration
+    endpoint (in bytes).
+    """
+
+    local_lru_arch_cache_size: int = 64
+    """
+    Number of built PKI architectures to keep around in each worker's local
+    cache. Set to zero to disable local caching.
+    """
+
+    response_format: str = 'json'
+    """
+    Format of the responses returned by the configuration endpoint.
+    Either ``json`` (the default) or ``msgpack``. The latter puts raw DER
+    bytes in the response instead of base64-encoded strings.
+    """
+
     enable_web_ui: bool = False
     """
     Whether to enable the web UI (the default is to disable it).
@@ -76,24 +115,116 @@ class Settings(config_utils.ConfigurableMixin):
     through the configuration endpoint.
     """
 
+    @classmethod
+    def process_entries(cls, config_dict):
+        super().process_entries(config_dict)
+        fmt = config_dict.get('response_format', 'json')
+        if fmt not in RESPONSE_FORMATS:
+            raise ConfigurationError(
+                f"Unsupported response format '{fmt}'; must be one of "
+                f"{', '.join(RESPONSE_FORMATS)}."
+            )
+
+
+def connect_redis(settings: Settings) -> redis.Redis:
+    if settings.redis_socket:
+        return redis.Redis(
+            unix_socket_path=settings.redis_socket, client_name='aas',
+            max_connections=settings.redis_pool_size
+        )
+    # redis-py already sets TCP_NODELAY on its connections
+    keepalive_options = {}
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        keepalive_options[socket.TCP_KEEPIDLE] = 30
+    return redis.Redis(
+        host=settings.redis_host, port=settings.redis_port, client_name='aas',
+        socket_keepalive=True, socket_keepalive_options=keepalive_options,
+        max_connections=settings.redis_pool_size
+    )
+
+
+@functools.lru_cache(maxsize=256)
+def fmt_arch_config_name(arch: ArchLabel) -> bytes:
+    return f'certomancer_{arch}_config'.encode('utf8')
 
-def fmt_arch_config_name(arch: ArchLabel):
-    return f'certomancer_{arch}_config'
+
+def config_hasher():
+    # We only need the hash for bucketing purposes, so a 128-bit BLAKE2b
+    # digest is more than enough (and cheaper than SHA-1).
+    return hashlib.blake2b(digest_size=16)
+
+
+CONFIG_READ_CHUNK_SIZE = 64 * 1024
+"""
+Chunk size used when reading configuration data from a request body.
+"""
+
+
+WRITE_FLUSH_THRESHOLD = 16
+"""
+Number of buffered cert writes after which the write pipeline is flushed
+to redis.
+"""
 
 
 class RedisBackedCertCache:
 
     def __init__(self, redis_instance: redis.Redis, arch: ArchLabel,
-                 ttl: int):
+                 ttl: int, write_pipe: redis.client.Pipeline):
         self.redis = redis_instance
         self.arch = arch
         self.ttl = ttl
+        self._prefix = f'certomancer_{arch}_cert_'.encode('utf8')
+        self._item_names: Dict[CertLabel, bytes] = {}
 
-        # this is reinitialised on every request, so we just dump everything
+        # writes are buffered, and sent to redis in bulk by the arch store
+        self.write_pipe = write_pipe
+
+        # this lives as long as the PKI architecture it belongs to, which is
+        # bounded by the size of the arch store's local cache
         self._cache: Dict[CertLabel, x509.Certificate] = {}
+        # prefetched certs that haven't been parsed yet
+        self._raw: Dict[CertLabel, bytes] = {}
+        # certs that weren't in redis when we last checked
+        self._missing: Set[CertLabel] = set()
 
-    def _fmt_item_name(self, item):
-        return f'certomancer_{self.arch}_cert_{item}'
+    def _fmt_item_name(self, item) -> bytes:
+        try:
+            return self._item_names[item]
+        except KeyError:
+            name = self._item_names[item] = \
+                self._prefix + str(item).encode('utf8')
+            return name
+
+    def prefetch(self, labels: Iterable[CertLabel]):
+        """
+        Load the certificates with the given labels from redis in a single
+        round trip.
+
+        Labels that aren't present in redis are remembered, so that looking
+        them up later doesn't require another round trip.
+        """
+        labels = [
+            label for label in labels
+            if label not in self._cache and label not in self._raw
+        ]
+        if not labels:
+            return
+        results = self.redis.mget(
+            [self._fmt_item_name(label) for label in labels]
+        )
+        found = 0
+        for label, result in zip(labels, results):
+            if result is None:
+                self._missing.add(label)
+            else:
+                # parsing is deferred until the cert is actually requested
+                self._raw[label] = result
+                found += 1
+        logger.debug(
+            "prefetched %d of %d certs from redis for arch '%s'",
+            found, len(labels), self.arch
+        )
 
     def __getitem__(self, item):
         try:
@@ -106,9 +237,14 @@ class RedisBackedCertCache:
         except KeyError:
             pass
 
-        result = self.redis.get(self._fmt_item_name(item))
-        if result is None:
+        if item in self._missing:
             raise KeyError(item)
+
+        result = self._raw.pop(item, None)
+        if result is None:
+            result = self.redis.get(self._fmt_item_name(item))
+            if result is None:
+                raise KeyError(item)
         cert: x509.Certificate = x509.Certificate.load(result)
         logger.debug(
             "cert '%s' retrieved from redis for arch '%s'", item, self.arch
@@ -120,40 +256,81 @@ class RedisBackedCertCache:
         if not isinstance(value, x509.Certificate):
             raise TypeError
         item_name = self._fmt_item_name(item)
-        self.redis.set(item_name, value.dump(), ex=self.ttl)
+        write_pipe = self.write_pipe
+        write_pipe.set(item_name, value.dump(), ex=self.ttl)
         self._cache[item] = value
+        self._raw.pop(item, None)
+        self._missing.discard(item)
         logger.debug(
             "cert '%s' inserted into cache for arch '%s'", item, self.arch
         )
+        if len(write_pipe) >= WRITE_FLUSH_THRESHOLD:
+            write_pipe.execute()
 
 
-def b64_asn1(obj):
-    return base64.b64encode(obj.dump()).decode('ascii')
+def b64_asn1(data: bytes):
+    return binascii.b2a_base64(data, newline=False).decode('ascii')
+
+
+def chain_labels(pki_arch: registry.PKIArchitecture,
+                 cert_spec: registry.CertificateSpec,
+                 chains: Dict[CertLabel, List[str]]) -> List[str]:
+    """
+    Equivalent to :meth:`registry.PKIArchitecture.get_chain`, but reuses
+    the chains computed for issuer certificates along the way.
+    """
+    cert_label = cert_spec.label
+    try:
+        return chains[cert_label]
+    except KeyError:
+        pass
+    if cert_spec.self_signed:
+        result = []
+    else:
+        issuer_label = cert_spec.resolve_issuer_cert(pki_arch)
+        issuer_spec = pki_arch.get_cert_spec(issuer_label)
+        result = [issuer_label.value] + \
+            chain_labels(pki_arch, issuer_spec, chains)
+    chains[cert_label] = result
+    return result
 
 
 def bundle_cert(pki_arch: registry.PKIArchitecture,
-                cert_spec: registry.CertificateSpec):
+                cert_spec: registry.CertificateSpec, binary=False,
+                chains: Optional[Dict[CertLabel, List[str]]] = None):
     cert_label = cert_spec.label
-    cert = pki_arch.get_cert(cert_label)
+    cert_bytes = pki_arch.get_cert(cert_label).dump()
     bundle = {
-        'cert': b64_asn1(cert),
-        'other_certs': [label.value for label in pki_arch.get_chain(cert_label)]
+        'cert': cert_bytes if binary else b64_asn1(cert_bytes),
+        'other_certs': chain_labels(
+            pki_arch, cert_spec, chains if chains is not None else {}
+        )
     }
 
     # bundle key if available
     if pki_arch.is_subject_key_available(cert_label):
         key = pki_arch.key_set.get_private_key(cert_spec.subject_key)
-        bundle['key'] = b64_asn1(key)
+        key_bytes = key.dump()
+        bundle['key'] = key_bytes if binary else b64_asn1(key_bytes)
 
     return bundle
 
 
-def jsonify_pki_arch(pki_arch: registry.PKIArchitecture):
+def iter_cert_specs(pki_arch: registry.PKIArchitecture) \
+        -> Iterable[registry.CertificateSpec]:
+    return chain.from_iterable(
+        iss_certs for _, iss_certs in pki_arch.enumerate_certs_by_issuer()
+    )
+
+
+def pki_arch_to_dict(pki_arch: registry.PKIArchitecture, binary=False):
 
+    chains: Dict[CertLabel, List[str]] = {}
     certs_dict = {
-        cert_spec.label.value: bundle_cert(pki_arch, cert_spec)
-        for iss, iss_certs in pki_arch.enumerate_certs_by_issuer()
-        for cert_spec in iss_certs
+        cert_spec.label.value: bundle_cert(
+            pki_arch, cert_spec, binary=binary, chains=chains
+        )
+        for cert_spec in iter_cert_specs(pki_arch)
     }
 
     services = pki_arch.service_registry
@@ -177,11 +354,30 @@ def jsonify_pki_arch(pki_arch: registry.PKIArchitecture):
         }
     }
 
-    return json.dumps({
+    return {
         'arch_label': str(pki_arch.arch_label),
         'cert_bundles': certs_dict,
         'services': service_dict
-    })
+    }
+
+
+def jsonify_pki_arch(pki_arch: registry.PKIArchitecture) -> bytes:
+    return orjson.dumps(pki_arch_to_dict(pki_arch))
+
+
+def msgpack_pki_arch(pki_arch: registry.PKIArchitecture) -> bytes:
+    return msgpack.packb(
+        pki_arch_to_dict(pki_arch, binary=True), use_bin_type=True
+    )
+
+
+RESPONSE_FORMATS = {
+    'json': (jsonify_pki_arch, 'application/json'),
+    'msgpack': (msgpack_pki_arch, 'application/msgpack'),
+}
+"""
+Supported response formats, mapped to a serialiser and a MIME type.
+"""
 
 
 class RedisBackedArchStore(animator.AnimatorArchStore):
@@ -195,9 +391,20 @@ class RedisBackedArchStore(animator.AnimatorArchStore):
 
         self.certomancer_config = certomancer_config
         self.settings = settings
-        self.redis = redis.Redis(
-            host=settings.redis_host, port=settings.redis_port
-        )
+        self.redis = connect_redis(settings)
+        # shared by all cert caches, see flush_pending_writes()
+        self._write_pipe = self.redis.pipeline(transaction=False)
+
+        # Architecture labels are content hashes, so the result of building
+        # an architecture from a given config never goes stale.
+        # This is an LRU cache: the most recently used architectures are
+        # at the end.
+        self._cache: OrderedDict[ArchLabel, registry.PKIArchitecture] = \
+            OrderedDict()
+        # serialised responses for architectures in the local cache
+        self._response_cache: Dict[ArchLabel, bytes] = {}
+        self._serialise, self.response_mimetype = \
+            RESPONSE_FORMATS[settings.response_format]
 
         super().__init__(certomancer_config.pki_archs)
 
@@ -208,6 +415,10 @@ class RedisBackedArchStore(animator.AnimatorArchStore):
         except KeyError:
             pass
 
+        pki_arch = self._get_cached(item)
+        if pki_arch is not None:
+            return pki_arch
+
         # if the specified architecture is not in the local cache, try to
         # grab the config from redis
         config_from_redis = self.redis.get(fmt_arch_config_name(item))
@@ -216,68 +427,150 @@ class RedisBackedArchStore(animator.AnimatorArchStore):
         else:
             return self.load_from_yaml(item, config_from_redis)
 
+    def _get_cached(self, arch: ArchLabel) \
+            -> Optional[registry.PKIArchitecture]:
+        cache = self._cache
+        try:
+            pki_arch = cache[arch]
+        except KeyError:
+            return None
+        cache.move_to_end(arch)
+        logger.debug("arch '%s' retrieved from local cache", arch)
+        return pki_arch
+
     def load_from_yaml(self, arch: ArchLabel, config: bytes) \
             -> registry.PKIArchitecture:
+        pki_arch = self._get_cached(arch)
+        if pki_arch is not None:
+            return pki_arch
+
+        pki_arch = self._build_arch(arch, config)
+        cache = self._cache
+        cache_size = self.settings.local_lru_arch_cache_size
+        if cache_size > 0:
+            cache[arch] = pki_arch
+            if len(cache) > cache_size:
+                evicted, _ = cache.popitem(last=False)
+                self._response_cache.pop(evicted, None)
+        return pki_arch
+
+    def serialise_arch(self, arch: ArchLabel,
+                       pki_arch: registry.PKIArchitecture) -> bytes:
+        """
+        Serialise a PKI architecture in the configured response format,
+        reusing the previous result if the architecture is in the local cache.
+        """
+        try:
+            return self._response_cache[arch]
+        except KeyError:
+            pass
+        data = self._serialise(pki_arch)
+        if arch in self._cache:
+            self._response_cache[arch] = data
+        return data
+
+    def _build_arch(self, arch: ArchLabel, config: bytes) \
+            -> registry.PKIArchitecture:
 
         config = config.decode('utf8')
-        parsed_config = yaml.safe_load(config)
+        parsed_config = yaml.load(config, Loader=_SafeLoader)
         settings = self.settings
+        cert_cache = RedisBackedCertCache(
+            self.redis, arch, ttl=settings.redis_cert_ttl,
+            write_pipe=self._write_pipe
+        )
         parsed = registry.PKIArchitecture.build_architecture(
             arch_label=arch, cfg=parsed_config,
             key_sets=self.certomancer_config.key_sets,
             external_url_prefix=self.certomancer_config.external_url_prefix,
-            cert_cache=RedisBackedCertCache(
-                self.redis, arch, ttl=settings.redis_cert_ttl,
-            )
+            cert_cache=cert_cache
+        )
+        cert_cache.prefetch(
+            cert_spec.label for cert_spec in iter_cert_specs(parsed)
         )
         return parsed
 
-    def register_new_architecture(self, config) -> registry.PKIArchitecture:
-        # There are probably better hashes than SHA-1 for bucketing purposes,
-        # but meh.
-        config_hash = hashlib.sha1(config).digest()
-        arch_label = ArchLabel(config_hash.hex())
-
-        # Here's the rationale for always performing SET EX in this scenario.
-        # There are two cases:
-        #  - the config hash doesn't exist in redis
-        #    Then we obviously want to insert it
-        #  - the config hash matches one that exists in redis
-        #    In this case, we want to make sure that the TTL for the
-        #    configuration in redis gets reset. Doing this through a normal
-        #    SET allows us to do that without incurring the risk of a race
-        #    condition. The TTL on any potential cached certs is a non-issue.
-
-        # The only drawback of this strategy is that the entire config is sent
-        #  to redis unconditionally, but the overhead for that should be
-        #  negligible.
-        # I *think* SET EX NX would not cause the TTL to be bumped
-        #  (but I'm not sure). If so, that's not an option.
-        # An alternative idea: do an EXISTS check + EXPIRE
-        #  in a pipeline with a WATCH and a conditional SET at the end,
-        #  but I'll file that under "premature optimisation".
+    def flush_pending_writes(self):
+        """
+        Send all buffered certificate writes to redis.
+
+        Certificates are generated lazily, so this should be called once
+        the response to a request has been computed.
+        """
+        if len(self._write_pipe):
+            self._write_pipe.execute()
+
+    def read_config(self, request: Request) -> Tuple[bytes, ArchLabel]:
+        """
+        Read a configuration from the request body, computing its hash
+        along the way.
+
+        Raises :class:`RequestEntityTooLarge` if the body exceeds the
+        configured maximum size.
+        """
+        max_size = self.settings.max_config_size
+        content_length = request.content_length
+        if content_length is not None and content_length > max_size:
+            raise RequestEntityTooLarge()
+
+        hasher = config_hasher()
+        buf = bytearray()
+        stream = request.stream
+        while True:
+            chunk = stream.read(CONFIG_READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            if len(buf) + len(chunk) > max_size:
+                raise RequestEntityTooLarge()
+            hasher.update(chunk)
+            buf += chunk
+        return bytes(buf), ArchLabel(hasher.hexdigest())
+
+    def register_new_architecture(self, config: bytes,
+                                  arch_label: Optional[ArchLabel] = None) \
+            -> registry.PKIArchitecture:
+        if arch_label is None:
+            hasher = config_hasher()
+            hasher.update(config)
+            arch_label = ArchLabel(hasher.hexdigest())
 
         try:
             arch = self.load_from_yaml(arch_label, config)
         except (yaml.YAMLError, ConfigurationError) as e:
             raise BadRequest(str(e))
-        self.redis.set(
-            fmt_arch_config_name(arch_label), config,
-            ex=self.settings.redis_arch_ttl
-        )
+
+        # Here's the rationale for the EXPIRE + SET NX dance.
+        # There are two cases:
+        #  - the config hash matches one that exists in redis
+        #    In this case, we only want to make sure that the TTL for the
+        #    configuration gets reset. The EXPIRE takes care of that, and
+        #    there's no need to send the config over the wire again.
+        #    This is the common case when parallel test runs submit the same
+        #    config.
+        #  - the config hash doesn't exist in redis
+        #    Then we obviously want to insert it. If another worker inserted
+        #    the same config in the meantime, SET NX is a no-op, which is fine
+        #    since the content (and the TTL) are equivalent anyway.
+        # The TTL on any potential cached certs is a non-issue.
+        config_key = fmt_arch_config_name(arch_label)
+        ttl = self.settings.redis_arch_ttl
+        if not self.redis.expire(config_key, ttl):
+            self.redis.set(config_key, config, ex=ttl, nx=True)
         return arch
 
     def __call__(self, environ, start_response):
-        request = Request(environ)
         try:
-            if request.path != '/':
+            # Look at the raw environ first, so rejected requests don't
+            # need a Request object
+            if environ.get('PATH_INFO', '').lstrip('/'):
                 raise NotFound()
-            elif request.method != 'POST':
+            elif environ.get('REQUEST_METHOD', 'GET').upper() != 'POST':
                 raise MethodNotAllowed()
-            config_data = request.stream.read()
-            pki_arch = self.register_new_architecture(config_data)
-            json_data = jsonify_pki_arch(pki_arch)
-            resp = Response(json_data, mimetype='application/json')
+            request = Request(environ)
+            config_data, arch_label = self.read_config(request)
+            pki_arch = self.register_new_architecture(config_data, arch_label)
+            data = self.serialise_arch(arch_label, pki_arch)
+            resp = Response(data, mimetype=self.response_mimetype)
 
         except HTTPException as e:
             resp = e
@@ -309,7 +602,10 @@ class CertomancerAsAService:
         )
 
     def __call__(self, environ, start_response):
-        return self._app(environ, start_response)
+        try:
+            return self._app(environ, start_response)
+        finally:
+            self.arch_store.flush_pending_writes()
 
 
 def logging_setup(level):
@@ -330,7 +626,7 @@ def run_cli():
     import sys
 
     with open(sys.argv[1], 'r') as inf:
-        cfg_data = yaml.safe_load(inf)
+        cfg_data = yaml.load(inf, Loader=_SafeLoader)
     sett = Settings.from_config(cfg_data.pop('on-demand-settings'))
     run_simple(
         '127.0.0.1', 9000, CertomancerAsAService(cfg_data, sett)
@@ -9,19 +9,28 @@ import os
 
 import yaml
 
-from certomancer_aas import Settings, CertomancerAsAService, logging_setup
+from certomancer_aas import Settings, CertomancerAsAService, logging_setup, \
+    _SafeLoader
 
 
 def from_env():
+    # The Docker image is supposed to ship a PyYAML build with libyaml
+    # support, so make some noise if that's not the case.
+    if not yaml.__with_libyaml__:
+        raise RuntimeError(
+            "PyYAML was built without libyaml support; the C loader is "
+            "not available."
+        )
+
     def _process_env_var(v):
-        try:
+        digits = v[1:] if v.startswith('-') else v
+        if digits.isdecimal():
             return int(v)
-        except ValueError:
-            pass
 
-        if v.casefold() == 'true':
+        folded = v.casefold()
+        if folded == 'true':
             return True
-        elif v.casefold() == 'false':
+        elif folded == 'false':
             return False
 
         return v
@@ -39,7 +48,7 @@ def from_env():
     # read config from the CERTOMANCER_CONFIG env var
     config_file = settings_dict.pop('config')
     with open(config_file, 'r') as inf:
-        cfg_data = yaml.safe_load(inf)
+        cfg_data = yaml.load(inf, Loader=_SafeLoader)
     settings = Settings.from_config(settings_dict)
     return CertomancerAsAService(cfg_data, settings)
 